@@ -0,0 +1,94 @@
+"""
+Micro-benchmark for ranker.py
+
+Compares ExpiringIngredientRanker with the nested loop that used to live in
+current_inventory_satisfies, on synthetic result rows. No database needed.
+
+    python bench_ranker.py
+    python bench_ranker.py --rows 10000 --expiring 500
+"""
+
+import random
+import timeit
+from datetime import date, timedelta
+
+import click
+
+from ranker import ExpiringIngredientRanker
+
+
+def make_rows(n_rows, n_ingredients, seed = 0):
+    rand = random.Random(seed)
+    rows = []
+    for i in range(n_rows):
+        ingredient_id = rand.randrange(n_ingredients)
+        rows.append({'recipe_name': 'recipe %d' % (i // 8),
+                     'ingredient_id': ingredient_id,
+                     'description': 'ingredient %d' % ingredient_id})
+    return rows
+
+
+def make_expiring(n_expiring, n_ingredients, seed = 0):
+    rand = random.Random(seed)
+    today = date.today()
+    return [(i, today + timedelta(rand.randrange(7)))
+            for i in rand.sample(range(n_ingredients), n_expiring)]
+
+
+def nested_loop(rows, expiring):
+    # The previous implementation, kept here as the baseline
+    expiring = sorted(expiring, key=lambda tup: tup[1])
+    going_bad_soon_list = [i[0] for i in expiring]
+    going_bad_soon_dates = [i[1].strftime("%B %d, %Y") for i in expiring]
+
+    prio_dict = dict()
+    for res in rows:
+        for i, zi in enumerate(zip(going_bad_soon_list, going_bad_soon_dates)):
+            red_id, re_date = zi
+            if res['ingredient_id'] == red_id:
+                res = dict(res)
+                res['exp_date'] = re_date
+                if i in prio_dict.keys():
+                    prio_dict[i].append(res)
+                else:
+                    prio_dict[i] = [res]
+                break
+    prio_dict = dict(sorted(prio_dict.items()))
+    prio_recipes = dict()
+
+    for k, v in prio_dict.items():
+        for res in v:
+            if res['description']+': '+res['exp_date'] not in prio_recipes.keys():
+                prio_recipes[res['description']+': '+res['exp_date']] = [res['recipe_name']]
+            else:
+                prio_recipes[res['description']+': '+res['exp_date']].append(res['recipe_name'])
+    return prio_recipes
+
+
+def ranker(rows, expiring):
+    ranker = ExpiringIngredientRanker(expiring)
+    ranker.add_rows(rows)
+    return ranker.ranked()
+
+
+@click.command()
+@click.option('--rows', default=10000, help='Number of result rows.')
+@click.option('--ingredients', default=2000, help='Number of distinct ingredients.')
+@click.option('--expiring', default=500, help='Number of expiring ingredients.')
+@click.option('--repeat', default=5, help='Best of this many runs is reported.')
+def run(rows, ingredients, expiring, repeat):
+    result_rows = make_rows(rows, ingredients)
+    expiring_ingredients = make_expiring(expiring, ingredients)
+
+    # Both must pick out the same number of recipe suggestions
+    expected = sum(len(v) for v in nested_loop(result_rows, expiring_ingredients).values())
+    assert expected == sum(len(r.recipes) for r in ranker(result_rows, expiring_ingredients))
+
+    print("%d rows, %d ingredients, %d expiring" % (rows, ingredients, expiring))
+    for name, func in [('nested loop', nested_loop), ('ranker', ranker)]:
+        times = timeit.repeat(lambda: func(result_rows, expiring_ingredients), number=1, repeat=repeat)
+        print("%-12s %8.2f ms" % (name, min(times) * 1000))
+
+
+if __name__ == "__main__":
+    run()
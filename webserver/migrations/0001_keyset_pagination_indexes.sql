@@ -0,0 +1,11 @@
+-- Indexes for the keyset pagination on /recipes and /reviews.
+--
+-- /recipes pages on Recipe.recipe_name, which is already covered by the
+-- primary key of Recipe. /reviews pages on the review_id of one user, and
+-- joins the page to Review_of_recipe on review_id.
+
+CREATE INDEX IF NOT EXISTS review_written_by_username_review_id_idx
+    ON Review_written_by (username, review_id);
+
+CREATE INDEX IF NOT EXISTS review_of_recipe_review_id_idx
+    ON Review_of_recipe (review_id);
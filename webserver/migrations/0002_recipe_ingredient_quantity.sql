@@ -0,0 +1,6 @@
+-- How much of an ingredient a recipe needs, in the same unit as
+-- Inventory_currently_has.quantity. Existing recipes need one of each.
+
+ALTER TABLE Recipe_ingredients
+    ADD COLUMN IF NOT EXISTS quantity INTEGER NOT NULL DEFAULT 1
+    CHECK (quantity > 0);
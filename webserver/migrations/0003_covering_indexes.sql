@@ -0,0 +1,41 @@
+-- Covering indexes for the filters and joins in server.py. The INCLUDE
+-- columns let the queries below be answered from the index alone.
+
+-- Inventory of one user: load_ingredients_in_inventory, the inventory sums in
+-- current_inventory_satisfies and load_recepe, delete_inventory_item
+CREATE INDEX IF NOT EXISTS inventory_currently_has_username_ingredient_id_idx
+    ON Inventory_currently_has (username, ingredient_id)
+    INCLUDE (quantity, expiration_date);
+
+-- Inventory id of a user: insert_inventory_item
+CREATE INDEX IF NOT EXISTS users_inventory_username_idx
+    ON Users_Inventory (username)
+    INCLUDE (inventory_id);
+
+-- Recipes using an ingredient: current_inventory_satisfies, allergy filter
+CREATE INDEX IF NOT EXISTS recipe_ingredients_ingredient_id_recipe_name_idx
+    ON Recipe_ingredients (ingredient_id, recipe_name)
+    INCLUDE (quantity);
+
+-- Ingredients of a recipe: ingredient counts in current_inventory_satisfies,
+-- load_recepe
+CREATE INDEX IF NOT EXISTS recipe_ingredients_recipe_name_ingredient_id_idx
+    ON Recipe_ingredients (recipe_name, ingredient_id)
+    INCLUDE (quantity);
+
+-- Reviews of a recipe: load_recepe, the duplicate check in add_review
+CREATE INDEX IF NOT EXISTS review_of_recipe_recipe_name_review_id_idx
+    ON Review_of_recipe (recipe_name, review_id);
+
+-- Ingredient by name: insert_inventory_item
+CREATE INDEX IF NOT EXISTS ingredient_description_idx
+    ON Ingredient (description)
+    INCLUDE (ingredient_id);
+
+-- Allergies of a user: get_user_allergies, allergy filter in
+-- current_inventory_satisfies
+CREATE INDEX IF NOT EXISTS users_allergies_username_allergy_type_idx
+    ON Users_allergies (username, allergy_type);
+
+CREATE INDEX IF NOT EXISTS allergy_examples_allergy_type_ingredient_id_idx
+    ON Allergy_examples (allergy_type, ingredient_id);
@@ -0,0 +1,88 @@
+"""
+Sampling profiler for individual routes.
+
+A background thread looks at the stack of every thread that is handling a
+profiled request every few milliseconds and counts the stacks per route.
+Unlike cProfile nothing is hooked into the function calls, so it is cheap
+enough to leave on for a selection of live requests.
+
+    sampler = RouteSampler(interval = 0.005)
+    sampler.start()
+
+    sampler.begin('home')    # in the thread that handles the request
+    ...
+    sampler.end()
+
+    sampler.collapsed('home')
+    # 'run (server.py:1066);home (server.py:306);load_data_for_user (server.py:612) 42\n...'
+
+collapsed() returns the stacks in the collapsed format, one "frame;frame;frame
+count" line per stack, which flamegraph.pl, speedscope and inferno read.
+"""
+
+import os
+import sys
+import threading
+from collections import Counter
+
+
+def collapse_stack(frame, max_depth):
+    names = []
+    while frame is not None and len(names) < max_depth:
+        code = frame.f_code
+        names.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class RouteSampler:
+
+    def __init__(self, interval = 0.005, max_depth = 64):
+        self.interval = interval
+        self.max_depth = max_depth
+
+        self.lock = threading.Lock()
+        self.active = dict()
+        self.stacks = dict()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def begin(self, route):
+        self.active[threading.get_ident()] = route
+
+    def end(self):
+        self.active.pop(threading.get_ident(), None)
+
+    def sample(self):
+        if not self.active:
+            return
+        frames = sys._current_frames()
+        with self.lock:
+            for thread_id, route in list(self.active.items()):
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = collapse_stack(frame, self.max_depth)
+                self.stacks.setdefault(route, Counter())[stack] += 1
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def sample_counts(self):
+        with self.lock:
+            return dict((route, sum(stacks.values())) for route, stacks in self.stacks.items())
+
+    def collapsed(self, route):
+        with self.lock:
+            stacks = self.stacks.get(route, Counter())
+            return ''.join('%s %d\n' % (stack, count) for stack, count in stacks.most_common())
@@ -0,0 +1,62 @@
+"""
+Ranks the recipes a user can make by how soon their ingredients go bad.
+
+The ranker is given the user's expiring ingredients up front, then the
+(recipe_name, ingredient_id, description) rows of the recipes the user can
+make, and groups the recipes under the ingredient they use in one pass:
+
+    ranker = ExpiringIngredientRanker([(3, date(2021, 12, 1)), (7, date(2021, 12, 3))])
+    ranker.add_rows(rows)
+    ranker.ranked()
+    # [ExpiringRecipes(ingredient_id=3, description='Milk',
+    #                  expiration_date=datetime.date(2021, 12, 1),
+    #                  recipes=['Pancakes', 'Waffles']), ...]
+"""
+
+import heapq
+from collections import namedtuple
+
+
+ExpiringRecipes = namedtuple('ExpiringRecipes', ['ingredient_id', 'description', 'expiration_date', 'recipes'])
+
+
+class ExpiringIngredientRanker:
+
+    def __init__(self, expiring_ingredients):
+        # ingredient_id -> earliest expiration date in the inventory
+        self.expiration_dates = dict()
+        for ingredient_id, expiration_date in expiring_ingredients:
+            known_date = self.expiration_dates.get(ingredient_id)
+            if known_date is None or expiration_date < known_date:
+                self.expiration_dates[ingredient_id] = expiration_date
+
+        self.descriptions = dict()
+        self.recipes = dict()
+
+    def add(self, recipe_name, ingredient_id, description):
+        if ingredient_id not in self.expiration_dates:
+            return
+        if ingredient_id in self.recipes:
+            self.recipes[ingredient_id].append(recipe_name)
+        else:
+            self.descriptions[ingredient_id] = description
+            self.recipes[ingredient_id] = [recipe_name]
+
+    def add_rows(self, rows):
+        for row in rows:
+            self.add(row['recipe_name'], row['ingredient_id'], row['description'])
+
+    def ranked(self, limit = None):
+        """
+    Returns an ExpiringRecipes record for every expiring ingredient that is
+    used by at least one recipe, soonest expiration date first. With limit
+    only the first limit records are selected, using a heap.
+        """
+        keys = [(self.expiration_dates[i], i) for i in self.recipes]
+        if limit is None:
+            keys.sort()
+        else:
+            keys = heapq.nsmallest(limit, keys)
+
+        return [ExpiringRecipes(i, self.descriptions[i], expiration_date, self.recipes[i])
+                for expiration_date, i in keys]
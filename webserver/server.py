@@ -17,18 +17,96 @@ Read about it online.
 
 import os
 import sys
+import gzip
+import hashlib
+import hmac
+import threading
+import atexit
+import time
+import traceback
 from sqlalchemy import *
 from sqlalchemy.pool import NullPool
-from flask import Flask, request, render_template, g, redirect, Response, url_for
+from flask import Flask, request, render_template, g, redirect, Response, url_for, abort
+from jinja2 import FileSystemBytecodeCache
 
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
 from env_variables import log_in_username, log_in_password
+from ranker import ExpiringIngredientRanker
+from write_behind import WriteBehindQueue
+from profiler import RouteSampler
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 tmpl_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
 app = Flask(__name__, template_folder=tmpl_dir)
 
 
+#
+# Static files and response size
+#
+# Stylesheets are linked through static_url() which appends a content hash,
+# so they can be cached by the browser for a long time and a changed file
+# simply gets a new URL.
+#
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+COMPRESS_MIN_SIZE = 500
+COMPRESS_MIMETYPES = ('text/html',)
+
+# Compiled templates are stored on disk so a new worker doesn't have to
+# compile them again. Without a directory Jinja uses a private per-user
+# one (mode 0700, owner checked), so nobody else can plant cache files.
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+
+static_fingerprints = dict()
+
+def static_fingerprint(filename):
+    if filename not in static_fingerprints:
+        with open(os.path.join(app.static_folder, filename), 'rb') as f:
+            static_fingerprints[filename] = hashlib.md5(f.read()).hexdigest()[:12]
+    return static_fingerprints[filename]
+
+@app.context_processor
+def static_url_processor():
+    def static_url(filename):
+        return url_for('static', filename=filename, v=static_fingerprint(filename))
+    return dict(static_url=static_url)
+
+@app.after_request
+def cache_and_compress(response):
+    """
+  Marks fingerprinted static files as immutable and compresses HTML
+  responses with brotli (if installed) or gzip when the client accepts it.
+    """
+    if request.endpoint == 'static':
+        if request.args.get('v'):
+            response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % STATIC_MAX_AGE
+        return response
+
+    if (response.direct_passthrough
+            or response.status_code != 200
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+
+    if brotli is not None and request.accept_encodings['br']:
+        response.set_data(brotli.compress(body))
+        response.headers['Content-Encoding'] = 'br'
+    elif request.accept_encodings['gzip']:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+
+    return response
+
+
 
 # XXX: The Database URI should be in the format of: 
 #
@@ -224,7 +302,10 @@ def preferences():
 def recipes():
     
     data = dict()
-    data = load_recipe_data(data, LOGGED_IN_AS, going_bad_soon = False)
+    data = load_recipe_data(data, LOGGED_IN_AS, going_bad_soon = False,
+                            after = request.args.get('after'),
+                            before = request.args.get('before'),
+                            per_page = page_size_arg(RECIPES_PAGE_SIZE))
     
     return render_template("recipes.html", **data)
     
@@ -232,8 +313,11 @@ def recipes():
 def reviews():
     
     data = load_data_for_user(LOGGED_IN_AS, going_bad_soon = False)
-    data = users_reviews(data)
-    data = recipes_list(data)
+    data = users_reviews(data,
+                         after = request.args.get('after', type=int),
+                         before = request.args.get('before', type=int),
+                         per_page = page_size_arg(REVIEWS_PAGE_SIZE))
+    data.update(review_recipe = request.args.get('recipe', ''))
     return render_template("reviews.html", **data)
 
 
@@ -305,6 +389,42 @@ def run_query_and_return_all(query, params):
     
     return ret_values
 
+
+#
+# Pagination
+#
+# Long lists are paged with a cursor on the sort column instead of an
+# OFFSET, e.g. /recipes?after=Pancakes returns the recipes following
+# "Pancakes". The database can then jump straight to the cursor through
+# the index on that column, so every page costs the same to fetch.
+#
+RECIPES_PAGE_SIZE = 25
+REVIEWS_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 100
+
+def page_size_arg(default):
+    per_page = request.args.get('per_page', default, type=int)
+    return max(1, min(per_page, MAX_PAGE_SIZE))
+
+def keyset_page(rows, key, per_page, after = None, before = None):
+    """
+  Cuts a page out of rows fetched with LIMIT per_page + 1 (in descending
+  order when paging backwards with before) and returns the page together
+  with the cursors for the previous and next pages, None if there is none.
+    """
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    
+    if before is not None:
+        rows = rows[::-1]
+        prev_cursor = rows[0][key] if has_more and rows else None
+        next_cursor = rows[-1][key] if rows else None
+    else:
+        next_cursor = rows[-1][key] if has_more else None
+        prev_cursor = rows[0][key] if after is not None and rows else None
+    
+    return rows, prev_cursor, next_cursor
+
 def load_ingredients_in_inventory(data, username, going_bad_soon = True):
     
     query = """
@@ -314,47 +434,55 @@ def load_ingredients_in_inventory(data, username, going_bad_soon = True):
     WHERE username = (%s)
     """
     
-    ingredients = run_query_and_return_all(query, (username))
+    ingredients = [dict(ing) for ing in run_query_and_return_all(query, (username))]
+    
+    for entry in pending_writes(username, 'add_inventory_item', 'remove_inventory_item'):
+        args = entry['args']
+        if entry['op'] == 'remove_inventory_item':
+            ingredients = [ing for ing in ingredients if ing['ingredient_id'] != args['ingredient_id']]
+        elif args['exp_date']:
+            ingredients.append({'ingredient_id': None,
+                                'expiration_date': datetime.strptime(args['exp_date'], '%Y-%m-%d').date(),
+                                'quantity': args['quantity'],
+                                'description': args['item'],
+                                'calories': args['calories']})
+    
     going_bad_soon_list = []
-    going_bad_ingredient_id = []
+    expiring_ingredients = []
     ret_ing = []
     for ing in ingredients:
-        ing = dict(ing)
-        if going_bad_soon:
-            if ing['expiration_date'] < date.today() + timedelta(7):
-                ing['expiration_date'] = ing['expiration_date'].strftime("%B %d, %Y")
-                going_bad_soon_list.append(ing)
-                going_bad_ingredient_id.append((ing['ingredient_id'], ing['expiration_date']))
-            else:
-                ing['expiration_date'] = ing['expiration_date'].strftime("%B %d, %Y")
-        else:
-            ing['expiration_date'] = ing['expiration_date'].strftime("%B %d, %Y")
+        expiration_date = ing['expiration_date']
+        ing['expiration_date'] = expiration_date.strftime("%B %d, %Y")
+        if not going_bad_soon or expiration_date < date.today() + timedelta(7):
             going_bad_soon_list.append(ing)
-            going_bad_ingredient_id.append((ing['ingredient_id'], ing['expiration_date']))
+            expiring_ingredients.append((ing['ingredient_id'], expiration_date))
                 
         ret_ing.append(ing)
     
     data.update(ingredients = ret_ing, going_bad_soon = going_bad_soon_list)
     
-    going_bad_ingredient_id = sorted(going_bad_ingredient_id, key=lambda tup: tup[1])
-
-    going_bad_ingredient_ids = [i[0] for i in going_bad_ingredient_id]
-    going_bad_ingredient_dates = [i[1] for i in going_bad_ingredient_id]
+    return data, expiring_ingredients
     
-    return data, going_bad_ingredient_ids, going_bad_ingredient_dates
-    
-def current_inventory_satisfies(data, username, going_bad_soon_list, going_bad_soon_dates, consider_alergies = True):
+def current_inventory_satisfies(data, username, expiring_ingredients, consider_alergies = True):
     
+    # A recipe can be made when the user has at least the required quantity of
+    # every ingredient. The quantities are compared for all recipes at once in
+    # the database: the inventory is summed per ingredient, divided by what
+    # each recipe needs, and the smallest ratio is the number of servings.
     if consider_alergies:
         query = """
-        SELECT available_recipies.recipe_name, ri2.ingredient_id, i2.description
+        SELECT available_recipies.recipe_name, available_recipies.servings, ri2.ingredient_id, i2.description
+        FROM (
+        SELECT ri.recipe_name, MIN(inv.quantity / ri.quantity) as servings
         FROM (
-        SELECT ri.recipe_name, ui.username
-        FROM Inventory_currently_has as uch
-        INNER JOIN Users_Inventory as ui ON (uch.inventory_id = ui.inventory_id)
-        INNER JOIN Recipe_ingredients as ri ON (ri.ingredient_id = uch.ingredient_id)
-        WHERE ui.username = (%s)
-        GROUP BY ui.username, ri.recipe_name
+          SELECT uch.ingredient_id, SUM(uch.quantity) as quantity
+          FROM Inventory_currently_has as uch
+          WHERE uch.username = (%s)
+          GROUP BY uch.ingredient_id
+        ) as inv
+        INNER JOIN Recipe_ingredients as ri ON (ri.ingredient_id = inv.ingredient_id)
+        WHERE inv.quantity >= ri.quantity
+        GROUP BY ri.recipe_name
         HAVING COUNT(ri.ingredient_id) = (
           SELECT COUNT(*)
           FROM Recipe_ingredients as inn_ri
@@ -368,19 +496,25 @@ def current_inventory_satisfies(data, username, going_bad_soon_list, going_bad_s
             from  Allergy_examples as ae
             inner join Users_allergies as ua on (ae.allergy_type = ua.allergy_type)
             inner join Recipe_ingredients as ri on (ri.ingredient_id = ae.ingredient_id)
-            where  ua.username = available_recipies.username
+            where  ua.username = (%s)
         )
+        ORDER BY available_recipies.servings DESC, available_recipies.recipe_name
     """
+        params = (username, username)
     else:
         query = """
-        SELECT available_recipies.recipe_name, ri2.ingredient_id, i2.description
+        SELECT available_recipies.recipe_name, available_recipies.servings, ri2.ingredient_id, i2.description
         FROM (
-        SELECT ri.recipe_name
-        FROM Inventory_currently_has as uch
-        INNER JOIN Users_Inventory as ui ON (uch.inventory_id = ui.inventory_id)
-        INNER JOIN Recipe_ingredients as ri ON (ri.ingredient_id = uch.ingredient_id)
-        WHERE ui.username = (%s)
-        GROUP BY ui.username, ri.recipe_name
+        SELECT ri.recipe_name, MIN(inv.quantity / ri.quantity) as servings
+        FROM (
+          SELECT uch.ingredient_id, SUM(uch.quantity) as quantity
+          FROM Inventory_currently_has as uch
+          WHERE uch.username = (%s)
+          GROUP BY uch.ingredient_id
+        ) as inv
+        INNER JOIN Recipe_ingredients as ri ON (ri.ingredient_id = inv.ingredient_id)
+        WHERE inv.quantity >= ri.quantity
+        GROUP BY ri.recipe_name
         HAVING COUNT(ri.ingredient_id) = (
           SELECT COUNT(*)
           FROM Recipe_ingredients as inn_ri
@@ -389,37 +523,24 @@ def current_inventory_satisfies(data, username, going_bad_soon_list, going_bad_s
         ) as available_recipies
         INNER JOIN Recipe_ingredients as ri2 ON (ri2.recipe_name = available_recipies.recipe_name)
         INNER JOIN Ingredient as i2 ON (ri2.ingredient_id = i2.ingredient_id)
+        ORDER BY available_recipies.servings DESC, available_recipies.recipe_name
         """
-    cursor = g.conn.execute(query, (username))
+        params = (username,)
+    cursor = g.conn.execute(query, params)
     
-    recipes = set()
-    prio_dict = dict()
+    recipe_servings = dict()
+    ranker = ExpiringIngredientRanker(expiring_ingredients)
 
     for res in cursor:
-        recipes.add(res['recipe_name'])
-        for i, zi in enumerate(zip(going_bad_soon_list, going_bad_soon_dates)):
-            red_id, re_date = zi
-            if res['ingredient_id'] == red_id:
-                res = dict(res)
-                res['exp_date'] = re_date
-                if i in prio_dict.keys():
-                    prio_dict[i].append(res)
-                else:
-                    prio_dict[i] = [res]
-                break
+        recipe_servings[res['recipe_name']] = res['servings']
+        ranker.add(res['recipe_name'], res['ingredient_id'], res['description'])
         
     cursor.close()
-    prio_dict = dict(sorted(prio_dict.items()))
-    prio_recipes = dict()
-
-    for k, v in prio_dict.items():
-        for res in v:
-            if res['description']+': '+res['exp_date'] not in prio_recipes.keys():
-                prio_recipes[res['description']+': '+res['exp_date']] = [res['recipe_name']]
-            else:
-                prio_recipes[res['description']+': '+res['exp_date']].append(res['recipe_name'])
+    prio_recipes = ranker.ranked()
     
-    data.update(currently_available_recipies = recipes, prio_recipes = prio_recipes)
+    data.update(currently_available_recipies = list(recipe_servings),
+                recipe_servings = recipe_servings,
+                prio_recipes = prio_recipes)
 
     return data
 
@@ -427,8 +548,8 @@ def load_data_for_user(username, going_bad_soon = True):
     
     data = dict()
     
-    data, going_bad_ingredient_id, going_bad_ingredient_dates = load_ingredients_in_inventory(data, username, going_bad_soon =going_bad_soon)
-    data = current_inventory_satisfies(data, username, going_bad_ingredient_id, going_bad_ingredient_dates)
+    data, expiring_ingredients = load_ingredients_in_inventory(data, username, going_bad_soon =going_bad_soon)
+    data = current_inventory_satisfies(data, username, expiring_ingredients)
     
     
     return data
@@ -445,23 +566,46 @@ def add_items_to_inventory():
         exp_date = request.form['exp_date']
         calories = request.form['calories']
     except:
-        exp_date = None
-        calories = 0
-        
+        return redirect('/inventory')
+
+    if WRITE_QUEUE is not None:
+        WRITE_QUEUE.enqueue('add_inventory_item', LOGGED_IN_AS, item=item, quantity=quantity,
+                            exp_date=exp_date, calories=calories)
+        return redirect('/inventory')
+    
+    insert_inventory_item(g.conn, LOGGED_IN_AS, item, quantity, exp_date, calories)
+    
+    return redirect('/inventory')
+    
+@app.route('/remove_item_from_inventory', methods=['POST'])
+def remove_item_from_inventory():
+    
+    ing_id = int(request.form['delete_invent_item'])
+    
+    if WRITE_QUEUE is not None:
+        WRITE_QUEUE.enqueue('remove_inventory_item', LOGGED_IN_AS, ingredient_id=ing_id)
+    else:
+        delete_inventory_item(g.conn, LOGGED_IN_AS, ing_id)
+    
+    return redirect('/inventory')
+
+
+def insert_inventory_item(conn, username, item, quantity, exp_date, calories):
+    
     find_item_query = """
     SELECT ingredient_id
     FROM Ingredient
     WHERE description = (%s)
     """
     
-    cursor = g.conn.execute(find_item_query, item)
+    cursor = conn.execute(find_item_query, item)
     
     if cursor.rowcount < 1:
         new_ing_id_query = """
         SELECT MAX(ingredient_id)
         FROM Ingredient
         """
-        cursor_2 = g.conn.execute(new_ing_id_query)
+        cursor_2 = conn.execute(new_ing_id_query)
         ingredient_id = cursor_2.first()[0] + 1
         cursor_2.close()
         
@@ -471,7 +615,7 @@ def add_items_to_inventory():
         """
         if not calories:
             calories = 0
-        cursor_3 = g.conn.execute(insert_new_ingredient, (ingredient_id, item, calories))
+        cursor_3 = conn.execute(insert_new_ingredient, (ingredient_id, item, calories))
         cursor_3.close()
     else:
         ingredient_id = cursor.first()[0]
@@ -483,7 +627,7 @@ def add_items_to_inventory():
     FROM Users_Inventory
     WHERE username = (%s)
     """
-    user_inventory_cursor = g.conn.execute(user_inventory_query, LOGGED_IN_AS)
+    user_inventory_cursor = conn.execute(user_inventory_query, username)
     inventory_id = user_inventory_cursor.first()[0]
     user_inventory_cursor.close()
     
@@ -492,57 +636,86 @@ def add_items_to_inventory():
     ((%s), (%s), (%s),  (%s), (%s))
     """
     try:
-        insert_cursor = g.conn.execute(insert_item_query, (inventory_id, LOGGED_IN_AS, ingredient_id, exp_date, quantity))
+        insert_cursor = conn.execute(insert_item_query, (inventory_id, username, ingredient_id, exp_date, quantity))
         insert_cursor.close()
     except:
-        pass
+        # In a write-behind batch the failed statement has aborted the
+        # transaction; the write's savepoint rolls it back and drops it
+        if conn.in_transaction():
+            raise
 
-    
-    return redirect('/inventory')
-    
-@app.route('/remove_item_from_inventory', methods=['POST'])
-def remove_item_from_inventory():
-    
-    ing_id = int(request.form['delete_invent_item'])
+
+def delete_inventory_item(conn, username, ingredient_id):
     del_query = """
     DELETE
     FROM Inventory_currently_has
     WHERE ingredient_id=(%s) AND username = (%s)
     """
-    del_cursor = g.conn.execute(del_query, (ing_id, LOGGED_IN_AS))
+    del_cursor = conn.execute(del_query, (ingredient_id, username))
     del_cursor.close()
-    
-    return redirect('/inventory')
 
 
-def users_reviews(data):
-    user_reviews_query = """
-    SELECT rr.recipe_name, rw.stars, rw.review_text, rw.review_id
-    FROM Review_written_by rwb, Review rw, Review_of_recipe rr
-    WHERE rwb.username = (%s)
-    AND rw.review_id = rwb.review_id
-    AND rw.review_id = rr.review_id
-    """
-    cursor = g.conn.execute(user_reviews_query, LOGGED_IN_AS)
+def users_reviews(data, after = None, before = None, per_page = REVIEWS_PAGE_SIZE):
+    if before is not None:
+        user_reviews_query = """
+        SELECT rr.recipe_name, rw.stars, rw.review_text, rw.review_id
+        FROM Review_written_by rwb, Review rw, Review_of_recipe rr
+        WHERE rwb.username = (%s)
+        AND rwb.review_id < (%s)
+        AND rw.review_id = rwb.review_id
+        AND rw.review_id = rr.review_id
+        ORDER BY rwb.review_id DESC
+        LIMIT (%s)
+        """
+        params = (LOGGED_IN_AS, before, per_page + 1)
+    elif after is not None:
+        user_reviews_query = """
+        SELECT rr.recipe_name, rw.stars, rw.review_text, rw.review_id
+        FROM Review_written_by rwb, Review rw, Review_of_recipe rr
+        WHERE rwb.username = (%s)
+        AND rwb.review_id > (%s)
+        AND rw.review_id = rwb.review_id
+        AND rw.review_id = rr.review_id
+        ORDER BY rwb.review_id
+        LIMIT (%s)
+        """
+        params = (LOGGED_IN_AS, after, per_page + 1)
+    else:
+        user_reviews_query = """
+        SELECT rr.recipe_name, rw.stars, rw.review_text, rw.review_id
+        FROM Review_written_by rwb, Review rw, Review_of_recipe rr
+        WHERE rwb.username = (%s)
+        AND rw.review_id = rwb.review_id
+        AND rw.review_id = rr.review_id
+        ORDER BY rwb.review_id
+        LIMIT (%s)
+        """
+        params = (LOGGED_IN_AS, per_page + 1)
+    
+    rows = run_query_and_return_all(user_reviews_query, params)
+    rows, prev_cursor, next_cursor = keyset_page(rows, 'review_id', per_page, after, before)
+    
     reviews_list = []
-    for res in cursor:
+    for res in rows:
         reviews_list.append([res['recipe_name'], res['stars'], res['review_text'], res['review_id']])
-    cursor.close()
-    data.update(reviews=reviews_list)
+    
+    # New reviews get the highest review_id, so pending ones go on the last page
+    for entry in pending_writes(LOGGED_IN_AS, 'add_review', 'delete_review'):
+        args = entry['args']
+        if entry['op'] == 'delete_review':
+            reviews_list = [r for r in reviews_list if r[3] != args['review_id']]
+        elif next_cursor is None:
+            reviews_list.append([args['recipe_name'], args['stars'], args['review_text'], None])
+    
+    data.update(reviews=reviews_list, prev_cursor=prev_cursor, next_cursor=next_cursor, per_page=per_page)
     return data
 
 
-def recipes_list(data):
-    recipes_query = """
-    SELECT recipe_name FROM Recipe ORDER BY recipe_name
+def recipe_exists(recipe_name):
+    recipe_query = """
+    SELECT recipe_name FROM Recipe WHERE recipe_name = (%s)
     """
-    cursor = g.conn.execute(recipes_query)
-    recipes_list = []
-    for res in cursor:
-        recipes_list.append(res['recipe_name'])
-    cursor.close()
-    data.update(recipes_list=recipes_list)
-    return data
+    return len(run_query_and_return_all(recipe_query, (recipe_name,))) > 0
 
 
 @app.route('/add_review', methods=['POST'])
@@ -551,6 +724,12 @@ def add_review():
     stars = int(request.form['rating'])
     review_text = request.form['review_text']
 
+    if not recipe_exists(recipe_name):
+        data = load_data_for_user(LOGGED_IN_AS, going_bad_soon = False)
+        data = users_reviews(data)
+        data.update(wrong_input='There is no recipe called ' + recipe_name + '.', review_recipe=recipe_name)
+        return render_template("reviews.html", **data)
+
     # Check if this user has already made a review for recipe_name
     check_query = """
     SELECT rw.review_id
@@ -563,54 +742,96 @@ def add_review():
     cursor0 = g.conn.execute(check_query, (LOGGED_IN_AS, recipe_name))
     res = cursor0.all()
     cursor0.close()
+    
+    # Reviews that are still in the write-behind queue count as well
+    deleted_ids = set(e['args']['review_id'] for e in pending_writes(LOGGED_IN_AS, 'delete_review'))
+    res = [r for r in res if r['review_id'] not in deleted_ids]
+    res += [e for e in pending_writes(LOGGED_IN_AS, 'add_review') if e['args']['recipe_name'] == recipe_name]
     if len(res) > 0:
         data = {'username': LOGGED_IN_AS}
         data = load_data_for_user(LOGGED_IN_AS, going_bad_soon = False)
         data = users_reviews(data)
-        data = recipes_list(data)
-        data.update(wrong_input='You have already reviewed this recipe!')
+        data.update(wrong_input='You have already reviewed this recipe!', review_recipe=recipe_name)
         return render_template("reviews.html", **data)
 
-    # Add review
+    if WRITE_QUEUE is not None:
+        WRITE_QUEUE.enqueue('add_review', LOGGED_IN_AS, recipe_name=recipe_name, stars=stars, review_text=review_text)
+    else:
+        insert_review(g.conn, LOGGED_IN_AS, recipe_name, stars, review_text)
+    return redirect('/reviews')
+
+
+@app.route('/delete_review', methods=['POST'])
+def delete_review():
+    rev_id = int(request.form['delete_review'])
+    if WRITE_QUEUE is not None:
+        WRITE_QUEUE.enqueue('delete_review', LOGGED_IN_AS, review_id=rev_id)
+    else:
+        delete_review_rows(g.conn, LOGGED_IN_AS, rev_id)
+    return redirect('/reviews')
+
+
+def insert_review(conn, username, recipe_name, stars, review_text):
     review_id_query = """
     SELECT MAX(review_id)
     FROM Review
     """
-    cursor1 = g.conn.execute(review_id_query)
+    cursor1 = conn.execute(review_id_query)
     rev_id = cursor1.first()[0] + 1
     cursor1.close()
     add_review_query = """
     INSERT INTO Review VALUES
     ((%s), (%s), (%s))
     """
-    cursor2 = g.conn.execute(add_review_query, (rev_id, stars, review_text))
+    cursor2 = conn.execute(add_review_query, (rev_id, stars, review_text))
     cursor2.close()
     add_review_written_query = """
     INSERT INTO Review_written_by VALUES
     ((%s), (%s))
     """
-    cursor3 = g.conn.execute(add_review_written_query, (LOGGED_IN_AS, rev_id))
+    cursor3 = conn.execute(add_review_written_query, (username, rev_id))
     cursor3.close()
     add_review_of_query = """
     INSERT INTO Review_of_recipe VALUES
     ((%s), (%s))
     """
-    cursor4 = g.conn.execute(add_review_of_query, (recipe_name, rev_id))
+    cursor4 = conn.execute(add_review_of_query, (recipe_name, rev_id))
     cursor4.close()
-    return redirect('/reviews')
 
 
-@app.route('/delete_review', methods=['POST'])
-def delete_review():
-    rev_id = int(request.form['delete_review'])
+def delete_review_rows(conn, username, review_id):
     del_query = """
     DELETE FROM Review_written_by WHERE review_id=(%s);
     DELETE FROM Review_of_recipe WHERE review_id=(%s);
     DELETE FROM Review WHERE review_id=(%s)
     """
-    del_cursor = g.conn.execute(del_query, (rev_id, rev_id, rev_id))
+    del_cursor = conn.execute(del_query, (review_id, review_id, review_id))
     del_cursor.close()
-    return redirect('/reviews')
+
+
+#
+# Write-behind
+#
+# With --write-behind the four routes above only journal their write in
+# WRITE_QUEUE and return; a background thread applies the writes in batches
+# (see write_behind.py). Until then the user's inventory and review lists
+# are patched with the pending writes by pending_writes(), so users see their
+# own changes right away. Recipe suggestions catch up after the flush.
+#
+WRITE_QUEUE = None
+WRITE_BEHIND_JOURNAL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'write_behind.journal')
+
+WRITE_FUNCS = {
+    'add_inventory_item': insert_inventory_item,
+    'remove_inventory_item': delete_inventory_item,
+    'add_review': insert_review,
+    'delete_review': delete_review_rows,
+}
+
+def pending_writes(username, *ops):
+    if WRITE_QUEUE is None:
+        return []
+    return WRITE_QUEUE.pending_for(username, ops or None)
 
 
 @app.route('/add_user', methods=['POST'])
@@ -640,22 +861,40 @@ def add_user():
         cursor.close()
     return render_template("signup.html", wrong_password='Sign Up Successful!')
     
-def load_recipe_data(data, username, going_bad_soon = False):
-    
-    recipe_query = """
-    SELECT recipe_name
-    FROM Recipe    
-    ORDER BY recipe_name
-    """
+def load_recipe_data(data, username, going_bad_soon = False, after = None, before = None, per_page = RECIPES_PAGE_SIZE):
     
-    recipe_cursor = g.conn.execute(recipe_query)
-    rec_names = []
-    for res in recipe_cursor:
-        rec_names.append(res['recipe_name'])
+    if before is not None:
+        recipe_query = """
+        SELECT recipe_name
+        FROM Recipe
+        WHERE recipe_name < (%s)
+        ORDER BY recipe_name DESC
+        LIMIT (%s)
+        """
+        params = (before, per_page + 1)
+    elif after is not None:
+        recipe_query = """
+        SELECT recipe_name
+        FROM Recipe
+        WHERE recipe_name > (%s)
+        ORDER BY recipe_name
+        LIMIT (%s)
+        """
+        params = (after, per_page + 1)
+    else:
+        recipe_query = """
+        SELECT recipe_name
+        FROM Recipe
+        ORDER BY recipe_name
+        LIMIT (%s)
+        """
+        params = (per_page + 1,)
     
-    recipe_cursor.close()
+    rows = run_query_and_return_all(recipe_query, params)
+    rows, prev_cursor, next_cursor = keyset_page(rows, 'recipe_name', per_page, after, before)
+    rec_names = [res['recipe_name'] for res in rows]
     
-    data.update(rescipes = rec_names)
+    data.update(rescipes = rec_names, prev_cursor = prev_cursor, next_cursor = next_cursor, per_page = per_page)
     
     return data
 
@@ -663,14 +902,16 @@ def load_recipe_data(data, username, going_bad_soon = False):
 def load_recepe(recipe_name):
     
     recipe_ingredient_query = """
-    SELECT r.recipe_name, ri.ingredient_id, i.description, ich.expiration_date
+    SELECT r.recipe_name, ri.ingredient_id, i.description, ri.quantity as required_quantity,
+           COALESCE(ich.quantity, 0) as quantity, ich.expiration_date
     FROM Recipe as r
     INNER JOIN Recipe_ingredients as ri ON (r.recipe_name = ri.recipe_name)
     INNER JOIN Ingredient as i ON (ri.ingredient_id = i.ingredient_id)
     LEFT JOIN (
-    SELECT *
+    SELECT iii.ingredient_id, SUM(iii.quantity) as quantity, MIN(iii.expiration_date) as expiration_date
     FROM Inventory_currently_has iii
     WHERE iii.username = (%s)
+    GROUP BY iii.ingredient_id
     ) as ich
     ON (ri.ingredient_id = ich.ingredient_id)
     WHERE r.recipe_name = (%s)
@@ -680,6 +921,11 @@ def load_recepe(recipe_name):
     ret_ing = rec_ing_cursor.all()
     rec_ing_cursor.close()
     
+    if ret_ing:
+        servings = min(ing['quantity'] // ing['required_quantity'] for ing in ret_ing)
+    else:
+        servings = 0
+    
     recipie_inst_query =  """
     SELECT r.recipe_name, r.instructions, AVG(stars) as avg_star
     FROM Recipe as r
@@ -725,7 +971,7 @@ def load_recepe(recipe_name):
     )
     
     
-    data = dict(recipe_ing = ret_ing, instruction = inst_display, recipe_name = recipe_name, avg_star = ret_stars, review_text = reviews)
+    data = dict(recipe_ing = ret_ing, servings = servings, instruction = inst_display, recipe_name = recipe_name, avg_star = ret_stars, review_text = reviews)
 
     return data
 
@@ -747,24 +993,36 @@ def get_user_allergies(username):
     return user_allergies
 
 
-def get_allergies(data, username):
-    user_allergies = get_user_allergies(username)
+def load_allergies(conn):
     all_allergies_query = """
     SELECT a.allergy_type, a.description
     FROM Allergies a
     ORDER BY a.allergy_type DESC
     """
-    cursor = g.conn.execute(all_allergies_query)
+    cursor = conn.execute(all_allergies_query)
+    allergies = [(res['allergy_type'], res['description']) for res in cursor]
+    cursor.close()
+    return allergies
+
+
+def all_allergies():
+    # The Allergies table is preloaded by the warm-up, if it ran
+    if 'allergies' in WARM_CACHE:
+        return WARM_CACHE['allergies']
+    return load_allergies(g.conn)
+
+
+def get_allergies(data, username):
+    user_allergies = get_user_allergies(username)
     allergies = []
-    for res in cursor:
+    for allergy_type, description in all_allergies():
         allergic_to = False
-        if res['allergy_type'] in user_allergies:
+        if allergy_type in user_allergies:
             allergic_to = True
         allergies.append({
-            'allergy_type': res['allergy_type'],
-            'allergy_desc': res['description'],
+            'allergy_type': allergy_type,
+            'allergy_desc': description,
             'allergic_to': allergic_to})
-    cursor.close()
     data.update(allergies=allergies)
     return data
 
@@ -773,14 +1031,7 @@ def get_allergies(data, username):
 def change_user_allergy():
     toggled_on = request.form.getlist('allergen')
     user_allergies = get_user_allergies(LOGGED_IN_AS)
-    all_allergies_query = """
-    SELECT a.allergy_type
-    FROM Allergies a
-    ORDER BY a.allergy_type DESC
-    """
-    cursor = g.conn.execute(all_allergies_query)
-    for res in cursor:
-        all_type = res['allergy_type']
+    for all_type, description in all_allergies():
         if all_type in user_allergies and all_type in toggled_on:
             # Do nothing
             continue
@@ -804,19 +1055,142 @@ def change_user_allergy():
         else:
             # Do nothing
             continue
-    cursor.close()
     return redirect('/preferences')
 
 
+#
+# Warm-up
+#
+# A freshly started worker has empty caches: no database connection in the
+# pool, no compiled templates and no allergy list in memory. When the
+# server is started with --warm-up, a background thread loads the Allergies
+# table (which the app never changes) and compiles every template while the
+# server is already accepting connections. /ready answers 503 until the warm-up is done (or has used up
+# its time budget), so a load balancer can hold traffic back until then.
+#
+WARM_CACHE = dict()
+WORKER_READY = threading.Event()
+WORKER_READY.set()
+
+def precompile_templates():
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+def warm_up(deadline):
+    steps = [
+        ('allergies', load_allergies),
+    ]
+    try:
+        conn = engine.connect()
+        try:
+            for key, load in steps:
+                if time.monotonic() > deadline:
+                    print("warm-up: out of time before loading %s" % key)
+                    return
+                WARM_CACHE[key] = load(conn)
+        finally:
+            conn.close()
+        
+        if time.monotonic() > deadline:
+            print("warm-up: out of time before compiling templates")
+            return
+        precompile_templates()
+        print("warm-up: done")
+    except:
+        print("warm-up failed, serving with cold caches")
+        traceback.print_exc()
+    finally:
+        WORKER_READY.set()
+
+def start_warm_up(budget):
+    """
+  Starts the warm-up in the background. The worker is marked ready once it
+  finishes, or after budget seconds at the latest.
+    """
+    WORKER_READY.clear()
+    threading.Thread(target=warm_up, args=(time.monotonic() + budget,), daemon=True).start()
+    timer = threading.Timer(budget, WORKER_READY.set)
+    timer.daemon = True
+    timer.start()
+
+@app.route('/ready')
+def ready():
+    if WORKER_READY.is_set():
+        return Response('ready', mimetype='text/plain')
+    return Response('warming up', status=503, mimetype='text/plain')
+
+
+#
+# Profiling
+#
+# With --profile a RouteSampler (see profiler.py) samples the stacks of the
+# requests to the routes given with --profile-route ('*' for all of them),
+# and of any request sent with an "X-Profile: <token>" header. The samples
+# are counted per route and can be downloaded in the collapsed stack format
+# from /profile/<route>.folded, e.g. to feed them to flamegraph.pl.
+#
+# The header and the /profile pages need the token given with
+# --profile-token. Without a token they only work from localhost.
+#
+PROFILER = None
+PROFILE_ROUTES = set()
+PROFILE_HEADER = 'X-Profile'
+PROFILE_TOKEN = None
+
+def profile_authorized():
+    if PROFILE_TOKEN is None:
+        return request.remote_addr in ('127.0.0.1', '::1')
+    return hmac.compare_digest(request.headers.get(PROFILE_HEADER, ''), PROFILE_TOKEN)
+
+@app.before_request
+def start_profiling():
+    if PROFILER is None or request.endpoint is None or request.endpoint.startswith('profile'):
+        return
+    if request.endpoint in PROFILE_ROUTES or '*' in PROFILE_ROUTES:
+        PROFILER.begin(request.endpoint)
+    elif PROFILE_HEADER in request.headers and profile_authorized():
+        PROFILER.begin(request.endpoint)
+
+@app.teardown_request
+def stop_profiling(exception):
+    if PROFILER is not None:
+        PROFILER.end()
+
+@app.route('/profile')
+def profile():
+    if PROFILER is None or not profile_authorized():
+        abort(404)
+    lines = ['%-30s %8d samples  /profile/%s.folded' % (route, count, route)
+             for route, count in sorted(PROFILER.sample_counts().items())]
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain')
+
+@app.route('/profile/<route>.folded')
+def profile_download(route):
+    if PROFILER is None or not profile_authorized():
+        abort(404)
+    return Response(PROFILER.collapsed(route), mimetype='text/plain',
+                    headers={'Content-Disposition': 'attachment; filename=%s.folded' % route})
+
+
 if __name__ == "__main__":
     import click
 
     @click.command()
     @click.option('--debug', is_flag=True)
     @click.option('--threaded', is_flag=True)
+    @click.option('--warm-up', is_flag=True, help='Preload tables and templates in the background.')
+    @click.option('--warm-up-budget', default=30.0, help='Seconds after which the worker is ready anyway.')
+    @click.option('--write-behind', is_flag=True, help='Journal review and inventory writes and apply them in batches.')
+    @click.option('--flush-interval', default=1.0, help='Seconds between write-behind flushes.')
+    @click.option('--write-behind-journal', default=WRITE_BEHIND_JOURNAL, help='Journal file for write-behind.')
+    @click.option('--profile', is_flag=True, help='Sample the stacks of profiled requests, see /profile.')
+    @click.option('--profile-route', multiple=True, help='Route (endpoint name) to profile, or * for all. Repeatable.')
+    @click.option('--profile-interval', default=5.0, help='Milliseconds between stack samples.')
+    @click.option('--profile-token', default=None, help='Secret for the X-Profile header and /profile. Localhost only without it.')
     @click.argument('HOST', default='0.0.0.0')
     @click.argument('PORT', default=8111, type=int)
-    def run(debug, threaded, host, port):
+    def run(debug, threaded, warm_up, warm_up_budget, write_behind, flush_interval, write_behind_journal,
+            profile, profile_route, profile_interval, profile_token, host, port):
         """
         This function handles command line parameters.
         Run the server using
@@ -830,6 +1204,21 @@ if __name__ == "__main__":
         """
 
         HOST, PORT = host, port
+        if warm_up:
+            start_warm_up(warm_up_budget)
+        # With --debug the reloader runs this function in a watcher process as
+        # well; only the process that serves requests may own the journal
+        if write_behind and (not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+            global WRITE_QUEUE
+            WRITE_QUEUE = WriteBehindQueue(engine, write_behind_journal, WRITE_FUNCS, flush_interval=flush_interval)
+            WRITE_QUEUE.start()
+            atexit.register(WRITE_QUEUE.stop)
+        if profile:
+            global PROFILER, PROFILE_TOKEN
+            PROFILER = RouteSampler(interval=profile_interval / 1000.0)
+            PROFILE_ROUTES.update(profile_route)
+            PROFILE_TOKEN = profile_token
+            PROFILER.start()
         print("running on %s:%d" % (HOST, PORT))
         app.run(host=HOST, port=PORT, debug=debug, threaded=threaded)
 
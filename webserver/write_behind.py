@@ -0,0 +1,150 @@
+"""
+Write-behind queue for the review and inventory routes.
+
+A write is appended to a journal file and fsync'ed before the route
+returns, so it survives a crash of the server. A background thread applies
+the journaled writes to the database in batches, one transaction per batch,
+and then drops them from the journal. Writes still in the journal at start
+up are applied by the first flush.
+
+    queue = WriteBehindQueue(engine, 'write_behind.journal', {'add_review': insert_review})
+    queue.start()
+    queue.enqueue('add_review', 'WHo', recipe_name='Pancakes', stars=5, review_text='Yum')
+
+Every write is passed to its apply function as apply(conn, username, **args).
+A write that fails is rolled back to its own savepoint, logged and dropped,
+like the synchronous routes ignore failed inserts. If the batch as a whole
+can't be committed (e.g. the database is down) it stays in the journal and
+is tried again on the next flush. A crash between the commit and the
+journal update means the batch is applied again, so writes are applied at
+least once.
+
+Only one queue can use a journal at a time; a second one on the same file
+raises RuntimeError.
+"""
+
+import fcntl
+import json
+import os
+import threading
+import traceback
+
+
+class WriteBehindQueue:
+
+    def __init__(self, engine, journal_path, apply_funcs, flush_interval = 1.0, batch_size = 100):
+        self.engine = engine
+        self.journal_path = journal_path
+        self.apply_funcs = apply_funcs
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+        # The journal itself is replaced on every flush, so the lock is held
+        # on a separate file that stays put
+        self.lock_file = open(journal_path + '.lock', 'w')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.lock_file.close()
+            raise RuntimeError("write-behind journal %s is in use by another process" % journal_path)
+
+        self.pending = []
+        if os.path.exists(journal_path):
+            with open(journal_path) as f:
+                self.pending = [json.loads(line) for line in f if line.strip()]
+        self.next_seq = max([entry['seq'] for entry in self.pending], default=0) + 1
+        self.journal = open(journal_path, 'a')
+
+    def enqueue(self, op, username, **args):
+        if op not in self.apply_funcs:
+            raise ValueError("unknown write %r" % op)
+        with self.lock:
+            entry = {'seq': self.next_seq, 'op': op, 'username': username, 'args': args}
+            self.next_seq += 1
+            self.journal.write(json.dumps(entry) + '\n')
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.pending.append(entry)
+        return entry
+
+    def pending_for(self, username, ops = None):
+        """
+    Returns the writes of username that are not in the database yet, oldest
+    first, optionally only those whose op is in ops.
+        """
+        with self.lock:
+            return [entry for entry in self.pending
+                    if entry['username'] == username and (ops is None or entry['op'] in ops)]
+
+    def flush(self):
+        """
+    Applies up to batch_size journaled writes in one transaction and returns
+    how many were taken off the queue.
+        """
+        with self.flush_lock:
+            with self.lock:
+                batch = self.pending[:self.batch_size]
+            if not batch:
+                return 0
+
+            with self.engine.begin() as conn:
+                for entry in batch:
+                    savepoint = conn.begin_nested()
+                    try:
+                        self.apply_funcs[entry['op']](conn, entry['username'], **entry['args'])
+                        savepoint.commit()
+                    except Exception:
+                        savepoint.rollback()
+                        print("write-behind: dropping failed write %r" % entry)
+                        traceback.print_exc()
+
+            with self.lock:
+                del self.pending[:len(batch)]
+                self._rewrite_journal()
+            return len(batch)
+
+    def _rewrite_journal(self):
+        # Called with self.lock held
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for entry in self.pending:
+                f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal.close()
+        os.replace(tmp_path, self.journal_path)
+        self.journal = open(self.journal_path, 'a')
+
+    def run(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                while self.flush() == self.batch_size:
+                    pass
+            except Exception:
+                print("write-behind: flush failed, retrying in %.1f s" % self.flush_interval)
+                traceback.print_exc()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+    Stops the background thread and makes a last attempt to flush. Whatever
+    can't be flushed stays in the journal for the next start.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        try:
+            while self.flush():
+                pass
+        except Exception:
+            traceback.print_exc()
+        self.journal.close()
+        self.lock_file.close()